@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from vega_datasets import data
-import math
+import base64
+import json
 import numpy as np
+import os
+import tempfile
 from config import state_abbr_map
 from pathlib import Path
 
@@ -19,7 +21,7 @@ st.set_page_config(
 
 
 
-@st.cache_data
+@st.cache_data(show_spinner=False)
 def get_registration_data():
     """Grab USA Hockey Registration data from a CSV file.
 
@@ -30,18 +32,134 @@ def get_registration_data():
 
     # Instead of a CSV on disk, you could read from an HTTP endpoint here too.
     DATA_FILENAME = Path(__file__).parent/'data/registration_by_state.csv'
-    df = pd.read_csv(DATA_FILENAME, thousands=',')
 
+    # The cleaned frame is kept next to the CSV as Parquet so a cold cache
+    # doesn't have to re-parse the text. It's rebuilt whenever the CSV changes.
+    # Bump PARQUET_VERSION whenever the cleaning below changes, so copies
+    # written by older code aren't picked up.
+    PARQUET_VERSION = 3
+    PARQUET_FILENAME = DATA_FILENAME.with_suffix(f'.v{PARQUET_VERSION}.parquet')
+
+    df = None
+
+    if (PARQUET_FILENAME.exists()
+            and PARQUET_FILENAME.stat().st_mtime >= DATA_FILENAME.stat().st_mtime):
+        try:
+            df = pd.read_parquet(PARQUET_FILENAME)
+        except (OSError, ValueError):
+            # Unreadable copy (e.g. a partial write); rebuild it from the CSV.
+            df = None
+
+    if df is None:
+        df = pd.read_csv(DATA_FILENAME, thousands=',')
+
+        # The 'Canada' district is filed under State 'Total', which would give
+        # 2024 two national totals. It isn't a US state, so drop it.
+        df = df[df['District'] != 'Canada'].copy()
+
+        # Years fit in int16 and state totals in int32, which keeps the columns
+        # we filter on small.
+        df['Year'] = pd.to_numeric(df['Year'], downcast='integer').astype('int16')
+        df['Total'] = pd.to_numeric(df['Total'], downcast='integer')
+
+        # State is low-cardinality, so store it as a categorical and filter on codes.
+        df['State'] = df['State'].astype('category')
+        df['id'] = df['State'].map(state_abbr_map)
+
+        # Keep rows ordered by year so a year range is a contiguous slice.
+        df = df.sort_values('Year', kind='stable').reset_index(drop=True)
+
+        # Write to a temp file and move it into place, so a crash or a second
+        # process never leaves a half-written Parquet file behind.
+        tmp_filename = None
+        try:
+            fd, tmp_filename = tempfile.mkstemp(
+                dir=PARQUET_FILENAME.parent, prefix=PARQUET_FILENAME.name, suffix='.tmp')
+            os.close(fd)
+            df.to_parquet(tmp_filename, compression='zstd')
+            os.replace(tmp_filename, PARQUET_FILENAME)
+        except OSError:
+            # Read-only checkout; we'll just parse the CSV again next time.
+            if tmp_filename is not None:
+                Path(tmp_filename).unlink(missing_ok=True)
 
-    df['Year'] = pd.to_numeric(df['Year'])
-    df['Total'] = pd.to_numeric(df['Total'])
-    
-    
     return df
 
+
+@st.cache_resource
+def get_registration_totals():
+    """Build a Year x State table of registration totals.
+
+    Per-state totals are then a keyed lookup rather than a boolean scan over
+    the whole frame. The table is read-only, so it's cached as a shared
+    resource instead of being copied on every rerun like st.cache_data does.
+    """
+
+    df = get_registration_data()
+    # pivot raises on duplicate (Year, State) rows rather than silently
+    # picking one of them.
+    return df.pivot(index='Year', columns='State', values='Total')
+
+
+@st.cache_resource
+def get_state_shapes():
+    """Grab the US state boundaries from a GeoJSON file.
+
+    It's shared across sessions, so treat it as read-only.
+    """
+
+    GEOJSON_FILENAME = Path(__file__).parent/'data/us_states.json'
+    with open(GEOJSON_FILENAME) as f:
+        return json.load(f)
+
+
+@st.cache_resource
+def get_state_map_url():
+    """Build the 2024 registration map data as a GeoJSON data URI.
+
+    Totals are joined onto the state shapes here rather than with a Vega
+    lookup in the browser. Streamlit re-sends inline chart data as an Arrow
+    table, which can't hold GeoJSON geometries, so the features are handed to
+    Vega by URL instead.
+    """
+
+    df = get_registration_data()
+    map_df = df.take(np.flatnonzero(df['Year'].to_numpy() == 2024))
+
+    # Several states can share one FIPS id (e.g. PA, E PA and W PA), so
+    # gather every row for an id rather than letting one of them win.
+    map_states = {}
+    map_totals = {}
+
+    for state, state_id, total in zip(
+            map_df['State'].tolist(), map_df['id'].tolist(), map_df['Total'].tolist()):
+        if not isinstance(state_id, str):
+            continue
+
+        map_states.setdefault(state_id, []).append(state)
+        map_totals[state_id] = map_totals.get(state_id, 0) + total
+
+    features = []
+
+    for f in get_state_shapes()['features']:
+        state_id = f['properties']['STATE']
+        states = map_states.get(state_id)
+        features.append({
+            **f,
+            # States without a 2024 total are still drawn, just uncolored.
+            'properties': {
+                **f['properties'],
+                'State': ', '.join(states) if states else None,
+                'Total': map_totals.get(state_id),
+            },
+        })
+
+    geojson = json.dumps(
+        {'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
+    return 'data:application/json;base64,' + base64.b64encode(geojson.encode()).decode()
+
 df = get_registration_data()
-df.style.format(thousands='')
-df['id']=df['State'].map(state_abbr_map)
+totals = get_registration_totals()
 
 # -----------------------------------------------------------------------------
 # Draw the actual page
@@ -58,8 +176,9 @@ As you'll notice, the data only goes back to 2007 right now, but data back to 19
 ''
 ''
 
-min_value = df['Year'].min()
-max_value = df['Year'].max()
+# The totals table is indexed by sorted year, so its ends are the year range.
+min_value = int(totals.index[0])
+max_value = int(totals.index[-1])
 
 from_year, to_year = st.slider(
     'Which years are you interested in?',
@@ -69,7 +188,7 @@ from_year, to_year = st.slider(
 
 
 
-states = df['State'].unique()
+states = df['State'].cat.categories.to_numpy()
 
 if not len(states):
     st.warning("Select at least one state")
@@ -83,12 +202,15 @@ selected_states = st.multiselect(
 ''
 ''
 
-# Filter the data
-filtered_df = df[
-    (df['State'].isin(selected_states))
-    & (df['Year'] <= to_year)
-    & (from_year <= df['Year'])
-]
+# Filter the data. Rows are sorted by year, so the year range is found with a
+# binary search; the state mask is then only built over that slice.
+year_col = df['Year'].to_numpy()
+lo = year_col.searchsorted(from_year, 'left')
+hi = year_col.searchsorted(to_year, 'right')
+year_slice = df.iloc[lo:hi]
+selected_codes = df['State'].cat.categories.get_indexer(selected_states)
+mask = np.isin(year_slice['State'].cat.codes.to_numpy(), selected_codes)
+filtered_df = year_slice.take(np.flatnonzero(mask))
 
 st.header('Registration count over time', divider='gray')
 
@@ -105,35 +227,31 @@ st.line_chart(
 ''
 
 
-first_year = df[df['Year'] == from_year]
-#print(first_year)
-last_year = df[df['Year'] == to_year]
-
 st.header(f'Total in {to_year}', divider='gray')
 
 ''
 
 cols = st.columns(4)
 
+first_regs = totals.loc[from_year, selected_states]
+last_regs = totals.loc[to_year, selected_states]
+growth = (last_regs / first_regs).astype('float64')
+
+# Missing years and a zero first year both give a non-finite ratio.
+bad = ~np.isfinite(growth.to_numpy())
+growths = pd.Series(
+    np.where(bad, 'n/a', [f'{g:,.2f}x' for g in growth]), index=growth.index)
+delta_colors = pd.Series(np.where(bad, 'off', 'normal'), index=growth.index)
+
 for i, state in enumerate(selected_states):
     col = cols[i % len(cols)]
 
     with col:
-        first_reg = first_year[df['State'] == state]['Total'].iat[0]
-        last_reg = last_year[df['State'] == state]['Total'].iat[0]
-
-        if math.isnan(first_reg):
-            growth = 'n/a'
-            delta_color = 'off'
-        else:
-            growth = f'{last_reg / first_reg:,.2f}x'
-            delta_color = 'normal'
-
         st.metric(
             label=f'{state} Player Count',
-            value=f'{last_reg}',
-            delta=growth,
-            delta_color=delta_color
+            value=f'{last_regs[state]}',
+            delta=growths[state],
+            delta_color=delta_colors[state]
         )
 
 
@@ -149,34 +267,35 @@ for i, state in enumerate(selected_states):
 
 # Add map
 
+# The map always shows every state; the selected ones are highlighted.
+# States missing from state_abbr_map have no shape, so they're just skipped.
+selected_ids = [
+    state_id for state_id in map(state_abbr_map.get, selected_states)
+    if state_id is not None]
 
-url_geojson = 'https://raw.githubusercontent.com/robbygrathwohl/USTemps/main/data/us_states.json'
-data_geojson_remote = alt.Data(url=url_geojson, format=alt.DataFormat(property='features',type='json'))
-
-# year = st.slider(
-#     'Which year are you interested in?',
-#     min_value=min_value,
-#     max_value=max_value,
-#     value = max_value
-# )
-
-filtered_map_df = df[df['Year'] == 2024]
+data_geojson = alt.Data(
+    url=get_state_map_url(), format=alt.DataFormat(property='features', type='json'))
 
 
 bin=[0, 10000, 20000, 30000, 40000, 50000, 60000]
 
 
-states_map = alt.Chart(data_geojson_remote).mark_geoshape(
+states_map = alt.Chart(data_geojson).mark_geoshape(
     stroke='white',
     strokeWidth=1
 ).encode(
-    color=alt.Color('Total:Q').scale(scheme='viridis', bins=bin, rangeMax=60000),
-    tooltip=['State:N', 'Total:Q']
+    color=alt.Color('properties.Total:Q', title='Total').scale(scheme='viridis', bins=bin, rangeMax=60000),
+    opacity=alt.condition(
+        f'indexof({json.dumps(selected_ids)}, datum.properties.STATE) >= 0',
+        alt.value(1.0),
+        alt.value(0.35),
+    ),
+    tooltip=[
+        alt.Tooltip('properties.State:N', title='State'),
+        alt.Tooltip('properties.Total:Q', title='Total'),
+    ]
 ).properties(
     title='USA Hockey 2024 Registration by State'
-).transform_lookup(
-     lookup='properties.STATE',
-     from_=alt.LookupData(filtered_map_df, 'id', ['Total', 'State'])
 ).project(
     type='albersUsa'
 )